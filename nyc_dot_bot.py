@@ -1,30 +1,55 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import dataclass
 from enum import Enum, auto
+import functools
+import hashlib
 import io
-import json
 import os
+import tempfile
+import time
 import traceback
 from urllib.parse import urljoin
 
-from atproto import Client, client_utils
+from aiolimiter import AsyncLimiter
+import aiohttp
 import click
-import boto3
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-from mastodon import Mastodon
-from pdf2image import convert_from_bytes
+from bs4 import BeautifulSoup, SoupStrainer
+from pdf2image import convert_from_path
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 import sentry_sdk
-import tweepy
 
 
-sentry_sdk.init(
-    traces_sample_rate=1.0,
-)
-
 load_dotenv()
 
 current_projects_url = "https://www1.nyc.gov/html/dot/html/about/current-projects.shtml"
 
+# Upper bound on posts in flight at once, to stay friendly to the APIs' rate limits
+MAX_CONCURRENT_LINKS = 8
+
+# How many extra links may download and render while every posting slot is busy
+PREFETCH_LINKS = 2
+
+# Links take 23 chars on Twitter and we want a space before it
+TWEET_MAX_LENGTH = 280 - 23 - 1
+SKEET_MAX_LENGTH = 300 - 1
+
+# Stored alongside the links in cache.json so unchanged pages can be skipped
+ETAG_KEY = "__etag"
+LAST_MODIFIED_KEY = "__last_modified"
+
+# PDFs are streamed to disk in chunks of this size rather than held in memory
+PDF_CHUNK_SIZE = 64 * 1024
+
+# Keep connections alive between requests to avoid repeated TLS handshakes
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
 bucket_name = (
     os.environ.get("BUCKET_NAME") or "nyc-dot-current-projects-bot-mastodon-staging"
 )
@@ -43,65 +68,169 @@ if os.environ.get("TWITTER_CONSUMER_KEY"):
 elif os.environ.get("BLUESKY_USERNAME"):
     PLATFORM = Platform.BLUESKY
 
+# Published posting rate limits as (posts, seconds), so bursts are paced instead of rejected
+RATE_LIMITS = {
+    Platform.MASTODON: (300, 5 * 60),
+    Platform.TWITTER: (200, 15 * 60),
+    Platform.BLUESKY: (5000, 60 * 60),
+}
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_FALLBACK_WAIT = 60
+# Longer resets (e.g. Twitter's daily cap) fail the link so it's retried on a
+# later run, rather than holding up this one past the next scheduled run
+RATE_LIMIT_MAX_WAIT = 2 * 60
+
 
 class TooManyNewPDFsException(Exception):
     pass
 
 
-def get_html():
-    projects_html = requests.get(current_projects_url)
+@dataclass(slots=True)
+class PdfLink:
+    href: str
+    text: str
+
+
+def get_html(cache):
+    headers = {}
+    if ETAG_KEY in cache:
+        headers["If-None-Match"] = cache[ETAG_KEY]
+    if LAST_MODIFIED_KEY in cache:
+        headers["If-Modified-Since"] = cache[LAST_MODIFIED_KEY]
+
+    projects_html = SESSION.get(current_projects_url, headers=headers)
+    if projects_html.status_code == 304:
+        return None
     projects_html.raise_for_status()
-    projects_html.encoding = "utf-8"
     return projects_html
 
 
+def get_cache_validators(projects_html):
+    validators = {}
+    if "ETag" in projects_html.headers:
+        validators[ETAG_KEY] = projects_html.headers["ETag"]
+    if "Last-Modified" in projects_html.headers:
+        validators[LAST_MODIFIED_KEY] = projects_html.headers["Last-Modified"]
+    return validators
+
+
 def get_pdf_links(projects_html):
-    soup = BeautifulSoup(projects_html.text, "html.parser")
+    # Only build a tree for the project listing, not the whole page
+    soup = BeautifulSoup(
+        projects_html.content,
+        "lxml",
+        # The strainer sees the raw class string, so match the token ourselves
+        parse_only=SoupStrainer(class_=lambda c: c and "view-content" in c.split()),
+        from_encoding="utf-8",
+    )
     content = soup.find(class_="view-content")
-    links = content.find_all("a")
+    return [
+        PdfLink(urljoin(current_projects_url, link["href"]), link.get_text())
+        for link in content.find_all("a", href=lambda href: href and href.endswith(".pdf"))
+    ]
 
-    pdf_links = []
-    for link in links:
-        if link["href"].endswith("pdf"):
-            pdf_links.append(link)
-    return pdf_links
 
+# Clients are kept at module scope so warm Lambda invocations reuse them.
+# Their libraries are imported here so a deploy only loads what it uses.
+@functools.cache
+def get_s3_client():
+    import boto3
 
-def get_s3_cache(client, key="cache.json"):
-    cache = client.get_object(Bucket=bucket_name, Key=key)
-    return json.loads(cache["Body"].read())
+    return boto3.client("s3")
 
 
-def get_local_cache(file_path):
-    with open(file_path) as f:
-        content = f.read()
-        return json.loads(content)
+@functools.cache
+def get_twitter_clients():
+    import tweepy
+
+    auth = tweepy.OAuth1UserHandler(
+        os.environ.get("TWITTER_CONSUMER_KEY"),
+        os.environ.get("TWITTER_CONSUMER_SECRET"),
+        os.environ.get("TWITTER_ACCESS_TOKEN"),
+        os.environ.get("TWITTER_ACCESS_TOKEN_SECRET"),
+    )
+    twitter_client_v1 = tweepy.API(auth)
+    twitter_client_v2 = tweepy.Client(
+        consumer_key=os.environ.get("TWITTER_CONSUMER_KEY"),
+        consumer_secret=os.environ.get("TWITTER_CONSUMER_SECRET"),
+        access_token=os.environ.get("TWITTER_ACCESS_TOKEN"),
+        access_token_secret=os.environ.get("TWITTER_ACCESS_TOKEN_SECRET"),
+    )
+    return twitter_client_v1, twitter_client_v2
+
 
+@functools.cache
+def get_bluesky_client():
+    from atproto import Client
 
-def get_pdf(link):
-    r = requests.get(link)
-    r.raise_for_status()
-    return r.content
+    bsky_client = Client()
+    bsky_client.login(os.environ.get("BLUESKY_USERNAME"), os.environ.get("BLUESKY_APP_PASSWORD"))
+    return bsky_client
 
 
-def convert_pdf_to_image(pdf):
-    buf = io.BytesIO()
-    image = convert_from_bytes(pdf)[0]
-    image.thumbnail((2048,2048))
-    image.save(buf, format="JPEG")
-    buf.seek(0)
-    return buf
+@functools.cache
+def get_mastodon_client():
+    from mastodon import Mastodon
+
+    return Mastodon(
+        api_base_url=os.environ.get("MASTODON_API_BASE_URL"),
+        access_token=os.environ.get("MASTODON_ACCESS_TOKEN"),
+    )
+
+
+def get_s3_cache(client, key="cache.json"):
+    cache = client.get_object(Bucket=bucket_name, Key=key)
+    return orjson.loads(cache["Body"].read())
+
+
+def get_local_cache(file_path):
+    with open(file_path, "rb") as f:
+        content = f.read()
+        return orjson.loads(content)
+
+
+async def get_pdf(session, link, f):
+    digest = hashlib.sha256()
+    async with session.get(link) as r:
+        r.raise_for_status()
+        async for chunk in r.content.iter_chunked(PDF_CHUNK_SIZE):
+            f.write(chunk)
+            digest.update(chunk)
+    f.flush()
+    return digest.hexdigest()
+
+
+# Rendering PDFs is CPU bound, so do it on every core while downloads continue.
+# Poppler does the work in its own process, so threads are enough for that.
+@functools.cache
+def get_render_pool():
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def convert_pdf_to_image(pdf_path):
+    # Let poppler scale and encode the first page itself so we can read the
+    # JPEG straight off disk instead of going through PIL.
+    with tempfile.TemporaryDirectory() as output_folder:
+        # Each worker renders its own PDF, so keep poppler to a single thread
+        image_path = convert_from_path(
+            pdf_path,
+            output_folder=output_folder,
+            paths_only=True,
+            thread_count=1,
+            fmt="jpeg",
+            jpegopt={"quality": 85, "progressive": True, "optimize": True},
+            single_file=True,
+            first_page=1,
+            last_page=1,
+            size=2048,
+        )[0]
+        with open(image_path, "rb") as f:
+            return f.read()
 
 
 def find_new_links(cached_links, current_links):
-    new_links = []
-    for link in current_links:
-        link["href"] = urljoin(
-            current_projects_url,
-            link["href"],
-        )
-        if link["href"] not in cached_links:
-            new_links.append(link)
+    cached = frozenset(cached_links)
+    new_links = [link for link in current_links if link.href not in cached]
 
     # prevent tweeting too many
     if len(new_links) > 1500:
@@ -111,89 +240,158 @@ def find_new_links(cached_links, current_links):
 
 
 def format_link_for_tweet(link):
-    max_length = 280 - 23 - 1
-    link_text = link.text
-    link_text = link_text.replace(" (pdf)", "")
-    if len(link_text) >= max_length:
-        link_text = f"{link_text[max_length-3]}..."
+    link_text = link.text.removesuffix(" (pdf)")
+    if len(link_text) >= TWEET_MAX_LENGTH:
+        link_text = f"{link_text[:TWEET_MAX_LENGTH-3]}..."
 
-    return f"{link_text} {link['href']}"
+    return f"{link_text} {link.href}"
 
 def truncate_text_for_skeet(link):
-    max_length = 300 - 1
-    link_text = link.text
-    link_text = link_text.replace(" (pdf)", "")
-    if len(link_text) >= max_length:
-        link_text = f"{link_text[max_length-3]}..."
+    link_text = link.text.removesuffix(" (pdf)")
+    if len(link_text) >= SKEET_MAX_LENGTH:
+        link_text = f"{link_text[:SKEET_MAX_LENGTH-3]}..."
 
     return link_text
 
 
-def tweet_new_links(links, dry_run=False, no_tweet=False):
+# Returns when a rate limited request can be retried, or None if it wasn't a 429
+def get_rate_limit_reset(e):
+    response = getattr(e, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+
+    # atproto keeps the server's header casing, so don't rely on it
+    headers = CaseInsensitiveDict(response.headers or {})
+    # Twitter and Bluesky both send the reset time as a unix timestamp
+    reset = headers.get("x-rate-limit-reset") or headers.get("ratelimit-reset")
+    if reset is None:
+        return time.time() + RATE_LIMIT_FALLBACK_WAIT
+    return float(reset)
+
+
+# Only status posts are passed a rate_limit, media uploads are not paced
+async def call_api(func, rate_limit=None):
+    # The API clients are blocking, so calls run in a worker thread
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        async with rate_limit or contextlib.nullcontext():
+            try:
+                return await asyncio.to_thread(func)
+            except Exception as e:
+                reset = get_rate_limit_reset(e)
+                if (
+                    reset is None
+                    or attempt == RATE_LIMIT_RETRIES
+                    or reset - time.time() > RATE_LIMIT_MAX_WAIT
+                ):
+                    raise
+
+        await asyncio.sleep(max(reset - time.time(), 0))
+
+
+def get_known_hashes(cache):
+    # Older entries only stored the link text, so they have no hash
+    return {
+        value["sha256"] for value in cache.values()
+        if isinstance(value, dict) and "sha256" in value
+    }
+
+
+async def tweet_new_links(links, known_hashes, dry_run=False, no_tweet=False):
     successes = {}
 
     if PLATFORM is Platform.TWITTER:
-        auth = tweepy.OAuth1UserHandler(
-            os.environ.get("TWITTER_CONSUMER_KEY"),
-            os.environ.get("TWITTER_CONSUMER_SECRET"),
-            os.environ.get("TWITTER_ACCESS_TOKEN"),
-            os.environ.get("TWITTER_ACCESS_TOKEN_SECRET"),
-        )
-        twitter_client_v1 = tweepy.API(auth)
-        twitter_client_v2 = tweepy.Client(
-            consumer_key=os.environ.get("TWITTER_CONSUMER_KEY"),
-            consumer_secret=os.environ.get("TWITTER_CONSUMER_SECRET"),
-            access_token=os.environ.get("TWITTER_ACCESS_TOKEN"),
-            access_token_secret=os.environ.get("TWITTER_ACCESS_TOKEN_SECRET"),
-        )
+        twitter_client_v1, twitter_client_v2 = get_twitter_clients()
     elif PLATFORM is Platform.BLUESKY:
-        bsky_client = Client()
-        bsky_client.login(os.environ.get("BLUESKY_USERNAME"), os.environ.get("BLUESKY_APP_PASSWORD"))
+        from atproto import client_utils
+
+        bsky_client = get_bluesky_client()
     else:
-        mastodon_client = Mastodon(
-            api_base_url=os.environ.get("MASTODON_API_BASE_URL"),
-            access_token=os.environ.get("MASTODON_ACCESS_TOKEN"),
-        )
+        mastodon_client = get_mastodon_client()
+
+    rate_limit = AsyncLimiter(*RATE_LIMITS[PLATFORM])
+
+    async def post(link, tweet_text, image):
+        if PLATFORM is Platform.TWITTER:
+            media = await call_api(
+                lambda: twitter_client_v1.media_upload(filename="", file=io.BytesIO(image)),
+            )
+            await call_api(
+                lambda: twitter_client_v2.create_tweet(text=tweet_text, media_ids=[media.media_id]),
+                rate_limit,
+            )
+        elif PLATFORM is Platform.BLUESKY:
+            await call_api(
+                lambda: bsky_client.send_image(
+                    text=client_utils.TextBuilder().link(
+                        truncate_text_for_skeet(link),
+                        link.href,
+                    ),
+                    image=image,
+                    image_alt="Screenshot of first page of PDF. Auto posted so can't describe, sorry."
+                ),
+                rate_limit,
+            )
+        else:
+            mastodon_media = await call_api(
+                lambda: mastodon_client.media_post(
+                    image,
+                    mime_type="image/jpeg",
+                    description="Screenshot of first page of PDF. Auto posted so can't describe, sorry.",
+                ),
+            )
+            await call_api(
+                lambda: mastodon_client.status_post(tweet_text, media_ids=[mastodon_media["id"]]),
+                rate_limit,
+            )
+
+    link_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LINKS + PREFETCH_LINKS)
+    post_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LINKS)
+
+    # Digests of PDFs currently being posted, so identical PDFs under other
+    # new URLs wait for that outcome instead of posting a second copy
+    in_flight = {}
 
     # If any of these fail, we want to record the rest succeeded so
     # we don't tweet them again. We still want them to go to sentry though.
-    for link in links:
-        try:
-            # link takes 23 chars and we want a space
-            tweet_text = format_link_for_tweet(link)
-            image_buf = convert_pdf_to_image(get_pdf(link["href"]))
-            
-            if dry_run or no_tweet:
-                print(f'Would have tweeted: "{tweet_text}"')
-            else:
-                if PLATFORM is Platform.TWITTER:
-                    media = twitter_client_v1.media_upload(filename="", file=image_buf)
-                    twitter_client_v2.create_tweet(text=tweet_text, media_ids=[media.media_id])
-                elif PLATFORM is Platform.BLUESKY:
-                    image = image_buf.read()
-
-                    bsky_client.send_image(
-                        text=client_utils.TextBuilder().link(
-                            truncate_text_for_skeet(link),
-                            link['href'],
-                        ),
-                        image=image,
-                        image_alt="Screenshot of first page of PDF. Auto posted so can't describe, sorry."
-                    )
-                else:
-                    image = image_buf.read()
-                    mastodon_media = mastodon_client.media_post(
-                        image,
-                        mime_type="image/png",
-                        description="Screenshot of first page of PDF. Auto posted so can't describe, sorry.",
-                    )
-                    mastodon_client.status_post(tweet_text, media_ids=[mastodon_media["id"]])
-
-            successes[link["href"]] = link.text
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
-            print(e)
-            traceback.print_exc()
+    async def process(session, link):
+        async with link_semaphore:
+            try:
+                tweet_text = format_link_for_tweet(link)
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+                    digest = await get_pdf(session, link.href, pdf_file)
+                    # The same PDF is sometimes re-posted under a new URL
+                    while digest in in_flight:
+                        await in_flight[digest].wait()
+                    if digest in known_hashes:
+                        print(f"Skipping {link.href}, already posted as another link")
+                        successes[link.href] = {"text": link.text, "sha256": digest}
+                        return
+
+                    in_flight[digest] = asyncio.Event()
+                    try:
+                        image = await asyncio.get_running_loop().run_in_executor(
+                            get_render_pool(), convert_pdf_to_image, pdf_file.name
+                        )
+
+                        if dry_run or no_tweet:
+                            print(f'Would have tweeted: "{tweet_text}"')
+                        else:
+                            async with post_semaphore:
+                                await post(link, tweet_text, image)
+
+                        known_hashes.add(digest)
+                    finally:
+                        in_flight.pop(digest).set()
+
+                successes[link.href] = {"text": link.text, "sha256": digest}
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                print(e)
+                traceback.print_exc()
+
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[process(session, link) for link in links])
 
     return successes
 
@@ -205,32 +403,54 @@ def run(event=None, context=None, local_cache=None, dry_run=False, no_tweet=Fals
     if local_cache:
         cache = get_local_cache(local_cache)
     else:
-        client = boto3.client("s3")
+        client = get_s3_client()
         cache = get_s3_cache(client)
 
-    new_links = find_new_links(cache, get_pdf_links(get_html()))
-
-    if not new_links:
+    projects_html = get_html(cache)
+    if projects_html is None:
         return
 
-    successes = tweet_new_links(new_links, dry_run, no_tweet)
+    new_links = find_new_links(cache, get_pdf_links(projects_html))
+
+    successes = {}
+    if new_links:
+        successes = asyncio.run(
+            tweet_new_links(new_links, get_known_hashes(cache), dry_run, no_tweet)
+        )
 
     if dry_run:
         return
 
+    # Only remember this version of the page once everything on it has been
+    # posted, otherwise a 304 next time would stop us retrying the failures.
+    if len(successes) == len(new_links):
+        successes.update(get_cache_validators(projects_html))
+
+    # Skip the write entirely when nothing new would be stored
+    if all(cache.get(key) == value for key, value in successes.items()):
+        return
+
     cache.update(successes)
     if local_cache:
-        with open(local_cache, "w") as f:
-            f.write(json.dumps(cache))
+        with open(local_cache, "wb") as f:
+            f.write(orjson.dumps(cache))
     else:
         client.put_object(
             Bucket=bucket_name,
             Key="cache.json",
-            Body=json.dumps(cache),
+            Body=orjson.dumps(cache),
         )
 
 
+@functools.cache
+def init_sentry():
+    sentry_sdk.init(
+        traces_sample_rate=1.0,
+    )
+
+
 def lambda_handler(event=None, context=None):
+    init_sentry()
     run()
 
 
@@ -241,6 +461,7 @@ def lambda_handler(event=None, context=None):
     "--local-cache", default=None, type=click.Path(dir_okay=False, writable=True)
 )
 def cli(dry_run, local_cache, no_tweet):
+    init_sentry()
     run(local_cache=local_cache, dry_run=dry_run, no_tweet=no_tweet)
 
 